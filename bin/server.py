@@ -62,18 +62,24 @@ class Server:
             Gets all of the active item ids and creates a
             product on WooCommerce that matches its data
         """
-
-        for item_id in self.active_item_ids:
-            self.woo.try_command('create_product', item_id)
+        self.woo.try_command('create_products', self.active_item_ids)
 
     def __woo_upload_metadata(self):
         """
             Once the products have been uploaded, we will
             have the post ids for each product, which is
             required to upload any images or other attributes
+
+            The queued up galleries are set even if one of the
+            products fails, so that the images already uploaded
+            for the others are not left out of their galleries
         """
-        for item_id in self.active_item_ids:
-            self.woo.try_command('upload_images', item_id)
+        try:
+            for item_id in self.active_item_ids:
+                self.woo.try_command('upload_images', item_id)
+        finally:
+            # Set the galleries for any products that are still queued up
+            self.woo.try_command('flush_gallery_updates', None)
 
     def __woo_delete_products(self):
         """
@@ -104,13 +110,20 @@ class Server:
             3. Upload the downloaded products to WooCommerce
             4. Upload the downloaded product metadata to WooCommerce
             5. Delete any products that ended on ebay from WooCommerce
-        """
-        self.__ebay_download_products()
-        # Disabled. Check the comment inside this method for more info
-        # self.__ebay_download_metadata()
-        self.__woo_upload_products()
-        self.__woo_upload_metadata()
-        self.__woo_delete_products()
+
+            The database connections are closed afterwards, even if
+            one of the steps fails
+        """
+        try:
+            self.__ebay_download_products()
+            # Disabled. Check the comment inside this method for more info
+            # self.__ebay_download_metadata()
+            self.__woo_upload_products()
+            self.__woo_upload_metadata()
+            self.__woo_delete_products()
+        finally:
+            self.ebay.db_close()
+            self.woo.db_close()
 
 if __name__ == '__main__':
     Server().start()
@@ -11,11 +11,46 @@ import uuid
 import sqlite3
 import logging
 import datetime
+import contextlib
 
 from .util import LOG_HANDLER
 
 import isodate
 
+# Columns that GetSellerList fills in for each item, and that are
+# compared to decide whether a stored item needs to be written again
+ITEM_COLUMNS = (
+    'active', 'available_quantity', 'title', 'start_date', 'end_date',
+    'category_id', 'category_name', 'condition_name', 'condition_description',
+)
+
+# Insert new items, and bring existing items up to date without touching
+# the columns that are filled in later (such as the `post_id`). Items that
+# have no SKU are given a random one, which is kept from then on
+STORE_ITEM_QUERY = """
+    INSERT INTO items (
+        item_id, active, available_quantity,
+        title, sku, start_date, end_date,
+        category_id, category_name, condition_name,
+        condition_description
+    ) VALUES (
+        :item_id, :active, :available_quantity,
+        :title, COALESCE(:sku, :new_sku), :start_date, :end_date,
+        :category_id, :category_name, :condition_name,
+        :condition_description)
+    ON CONFLICT (item_id) DO UPDATE SET
+        active = excluded.active,
+        available_quantity = excluded.available_quantity,
+        title = excluded.title,
+        sku = COALESCE(:sku, items.sku, excluded.sku),
+        start_date = excluded.start_date,
+        end_date = excluded.end_date,
+        category_id = excluded.category_id,
+        category_name = excluded.category_name,
+        condition_name = excluded.condition_name,
+        condition_description = excluded.condition_description
+"""
+
 class Database:
     """
         Provides common methods for interacting with the local
@@ -35,16 +70,63 @@ class Database:
         self.__database = sqlite3.connect(
             os.environ.get('database_file', 'database/ebay_items.db'),
             isolation_level=None,
-            detect_types=detect_types)
+            detect_types=detect_types,
+            # Every query is a constant string, so keep them all compiled
+            cached_statements=256)
 
         with self.__database:
             # Get column names with select queries
             self.__database.row_factory = sqlite3.Row
             # Get a cursor to execute statements
             self.__cursor = self.__database.cursor()
+        self.__set_pragmas()
         self.__create_tables()
         self.__migrate_tables()
 
+    def __set_pragmas(self):
+        """
+            Switches the database to write-ahead logging, so that each
+            write appends to the log instead of rewriting the journal,
+            and readers don't have to wait on writers
+
+            With WAL, `synchronous=NORMAL` only syncs at checkpoints,
+            which is still safe against the program crashing
+
+            The page cache is raised to 64MB, temporary tables and indices
+            are kept in memory, and up to 256MB of the file is memory mapped
+            so that reads don't have to be copied out of the OS cache
+        """
+        journal_mode = self.__execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if journal_mode != 'wal':
+            self.log.warning('Unable to use WAL, the journal mode is %s', journal_mode)
+
+        self.__execute('PRAGMA synchronous=NORMAL')
+        self.__execute('PRAGMA temp_store=MEMORY')
+        # Negative values are in KiB rather than pages
+        self.__execute('PRAGMA cache_size=-65536')
+        self.__execute('PRAGMA mmap_size=268435456')
+
+    def db_close(self):
+        """
+            Lets sqlite update its query planner statistics, moves everything
+            in the write-ahead log back into the database file (emptying the
+            log so it doesn't keep growing between runs), and then closes the
+            database connection
+
+            The connection is closed even if the housekeeping fails (such as
+            when another connection has the database locked), so that
+            closing one shim's database never stops the next from closing
+
+            Returns None
+        """
+        try:
+            self.__execute('PRAGMA optimize')
+            self.__execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            self.log.warning('Unable to tidy up the database before closing it: %s', e)
+        finally:
+            self.__database.close()
+
     def __create_tables(self):
         """
             Creates a table called `items` and another called `item_metadata`
@@ -53,6 +135,9 @@ class Database:
             `items` contains the primary information about items that we're
             interested in, while `item_metadata` contains a key-value store
             of ItemSpecifics, which is fluid and will generally contain specs
+
+            `media` remembers each image that has been uploaded to wordpress,
+            so that it isn't downloaded or searched for again on later runs
         """
 
         self.__cursor.executescript("""
@@ -84,6 +169,13 @@ class Database:
                 key CHAR PRIMARY KEY NOT NULL UNIQUE,
                 value TEXT
             );
+
+            CREATE TABLE IF NOT EXISTS media (
+                slug TEXT PRIMARY KEY NOT NULL,
+                item_id INTEGER,
+                media_id INTEGER,
+                url TEXT
+            );
         """)
 
     def __migrate_tables(self):
@@ -98,15 +190,21 @@ class Database:
             self.__execute('PRAGMA user_version')
             return self.__cursor.fetchone()[0]
 
+        # Several migrations can be applied in one launch, so
+        # count the version up as each one is added to the query
+        version = get_version()
+
         def increment_version():
             """
                 Increases the current Schema by 1
             """
-            return "PRAGMA user_version = {v:d};".format(v=get_version() + 1)
+            nonlocal version
+            version += 1
+            return "PRAGMA user_version = {v:d};".format(v=version)
 
         query = ""
 
-        if get_version() < 1:
+        if version < 1:
             """
                 Add some internal values to track the state across different launches
             """
@@ -117,6 +215,32 @@ class Database:
             """
             query += increment_version()
 
+        if version < 2:
+            """
+                Keep metadata unique with an index, rather than searching for an
+                exact match before every insert. Duplicates have to go first
+            """
+            query += """
+                DELETE FROM item_metadata WHERE id NOT IN (
+                    SELECT MIN(id) FROM item_metadata GROUP BY item_id, key, value
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS item_metadata_unique
+                    ON item_metadata (item_id, key, value);
+            """
+            query += increment_version()
+
+        if version < 3:
+            """
+                Index the columns used to find the active items that still need
+                to be uploaded, so that it doesn't have to scan every item.
+                Metadata lookups by item_id already use item_metadata_unique
+            """
+            query += """
+                CREATE INDEX IF NOT EXISTS items_active
+                    ON items (active, post_id);
+            """
+            query += increment_version()
+
         self.__cursor.executescript(query)
 
     def __execute(self, query, values={}):
@@ -160,42 +284,53 @@ class Database:
 
             We strip the timezone because sqlite's datetime parser doesn't
             know how to deal with them. Ebay's item times are always in UTC
-        """
-        return isodate.parse_datetime(time_string).replace(tzinfo=None)
 
-    def db_store_item_from_ebay(self, item):
+            Ebay's times (such as 2020-07-01T12:00:00.000Z) are parsed by the
+            standard library, which does it in C. `isodate` handles anything
+            else. `fromisoformat` doesn't accept the `Z` suffix before Python
+            3.11, so it is swapped for the equivalent offset
         """
-            Store the provided `item`, which is a dictionary,
-            into the local database. This gets all information
-            that is normally returned from GetSellerList.
+        try:
+            parsed = datetime.datetime.fromisoformat(time_string.replace('Z', '+00:00'))
+        except ValueError:
+            parsed = isodate.parse_datetime(time_string)
+        return parsed.replace(tzinfo=None)
 
-            For ItemSpecifics, we will have to make a seperate
-            API call to GetItem with the DetailLevel set to
-            ReturnAll (something that is not allowed on bulk
-            queries such as GetSellerList and GetSellerEvents)
+    @contextlib.contextmanager
+    def db_transaction(self):
         """
+            Groups all of the writes made inside of a `with` block
+            into one transaction, so that they are committed (and
+            synced to disk) together instead of one at a time
 
-        # INSERT OR REPLACE so that we can always ensure that the
-        # saved information is up to date (or at least recent)
-        query = """
-            INSERT OR REPLACE INTO items (
-                item_id, active, available_quantity,
-                title, sku, start_date, end_date,
-                category_id, category_name, condition_name,
-                condition_description
-            ) VALUES (
-                :item_id, :active, :available_quantity,
-                :title, :sku, :start_date, :end_date,
-                :category_id, :category_name, :condition_name,
-                :condition_description)
+            If anything inside the block raises, or the commit itself
+            fails (such as when the database is busy), the writes are
+            rolled back and the exception is raised again, so that the
+            next transaction can begin
         """
+        self.__execute('BEGIN')
+        try:
+            yield self
+            self.__execute('COMMIT')
+        except BaseException:
+            # sqlite may have already rolled back on its own
+            if self.__database.in_transaction:
+                self.__execute('ROLLBACK')
+            raise
 
+    def __get_item_values(self, item):
+        """
+            Converts the provided `item`, which is a dictionary
+            from GetSellerList, into the named parameters for
+            the `items` table
+        """
         values = {
             'item_id': int(item['ItemID']),
             'active': item['SellingStatus']['ListingStatus'],
             'available_quantity': int(item['Quantity']) - int(item['SellingStatus']['QuantitySold']),
             'title': item['Title'],
-            'sku': item.get('SKU', uuid.uuid4().hex),
+            'sku': item.get('SKU'),
+            'new_sku': uuid.uuid4().hex,
             'start_date': self.__get_datetime_obj(item['ListingDetails']['StartTime']),
             'end_date': self.__get_datetime_obj(item['ListingDetails']['EndTime']),
             'category_id': int(item['PrimaryCategory']['CategoryID']),
@@ -211,42 +346,94 @@ class Database:
         if item.get('ConditionDescription', False):
             values['condition_description'] = item['ConditionDescription']
 
-        self.__execute(query, values)
+        return values
+
+    def __is_item_unchanged(self, stored, values):
+        """
+            Compares the `stored` row of an item with the `values`
+            it would be written with, and returns True if writing
+            them would not change anything
+
+            The SKU is only compared when the item has one, because
+            items without one keep the random SKU they were given
+        """
+        if stored is None:
+            return False
+
+        if values['sku'] is not None and values['sku'] != stored['sku']:
+            return False
+
+        return all(stored[column] == values[column] for column in ITEM_COLUMNS)
+
+    def db_store_item_from_ebay(self, item):
+        """
+            Store the provided `item`, which is a dictionary,
+            into the local database. This gets all information
+            that is normally returned from GetSellerList.
+
+            For ItemSpecifics, we will have to make a seperate
+            API call to GetItem with the DetailLevel set to
+            ReturnAll (something that is not allowed on bulk
+            queries such as GetSellerList and GetSellerEvents)
+        """
+        self.__execute(STORE_ITEM_QUERY, self.__get_item_values(item))
 
         return self
 
-    def __store_key_value(self, item_id, key, value):
-        has_metadata = "%d already has metadata for %s"
+    def db_store_items_from_ebay(self, items):
+        """
+            Store all of the provided `items` (a page of GetSellerList)
+            into the local database, like `db_store_item_from_ebay`
 
-        # Determine if we already have a record that matches exactly
-        query_for_existing = """
-            SELECT * FROM item_metadata
-            WHERE
-                item_id = :item_id AND
-                key = :key AND
-                value = :value
+            The stored rows for the whole page are read with one query
+            first, and items where none of the `ITEM_COLUMNS` (or the SKU)
+            have changed since the last run are not written again.
+            The rest are written with a single `executemany`
+        """
+        rows = [ self.__get_item_values(item) for item in items ]
+        if not rows:
+            return self
+
+        query = """
+            SELECT item_id, sku, %s
+            FROM items WHERE item_id IN (%s)
+        """ % (', '.join(ITEM_COLUMNS), ', '.join('?' * len(rows)))
+
+        self.__execute(query, [ row['item_id'] for row in rows ])
+        stored = { row['item_id']: row for row in self.__fetchall() }
+
+        changed = [
+            row for row in rows
+            if not self.__is_item_unchanged(stored.get(row['item_id']), row)
+        ]
+        if changed:
+            self.__cursor.executemany(STORE_ITEM_QUERY, changed)
+
+        self.log.debug('%d of %d items were unchanged', len(rows) - len(changed), len(rows))
+
+        return self
+
+    def __store_key_values(self, item_id, metadata):
         """
+            Stores all of the `metadata`, which is a list of (key, value)
+            tuples, for the integer `item_id` with a single `executemany`
 
-        query_to_insert = """
-            INSERT INTO item_metadata (
+            Metadata that matches exactly is ignored by the unique index
+        """
+        query = """
+            INSERT OR IGNORE INTO item_metadata (
                 item_id, key, value
             ) values (:item_id, :key, :value)
         """
 
-        values = {
-            'item_id': int(item_id),
-            'key': key,
-            'value': value,
-        }
-
-        metadata_count = len(
-            self.__execute(query_for_existing, values).fetchall()
-        )
+        values = [
+            {'item_id': item_id, 'key': key, 'value': value}
+            for key, value in metadata
+        ]
 
-        if metadata_count == 0:
-            self.__execute(query_to_insert, values)
-        else:
-            self.log.debug(has_metadata % (int(item_id), value))
+        inserted = self.__cursor.executemany(query, values).rowcount
+        self.log.debug('%d already had %d of %d metadata values',
+            item_id, len(values) - inserted, len(values))
 
     def db_store_item_metadata_from_ebay(self, item):
         """
@@ -258,47 +445,50 @@ class Database:
             are what are normally provided. When this is called from
             GetItem, ItemSpecifics are what are normally provided
         """
+        item_id = int(item['ItemID'])
+        metadata = list()
 
         # PictureDetails exists on GetSellerList and GetItem, so this should always get hit
         if item.get('PictureDetails', False):
-            self.log.debug('Found Picture Details for %d' % (int(item['ItemID'])))
+            self.log.debug('Found Picture Details for %d', item_id)
             if type(item['PictureDetails']['PictureURL']) is list:
                 for picture in item['PictureDetails']['PictureURL']:
-                    self.__store_key_value(item['ItemID'], 'picture_url', picture)
+                    metadata.append(('picture_url', picture))
 
             # Case for only one picture being on a listing
             elif type(item['PictureDetails']['PictureURL']) is str:
-                self.__store_key_value(
-                    item['ItemID'], 'picture_url',
-                    item['PictureDetails']['PictureURL'])
+                metadata.append(('picture_url', item['PictureDetails']['PictureURL']))
 
             else:
                 err_msg = 'Unexpected type %s from PictureDetails. Expecting either list or str'
-                self.log.error(err_msg % (type(item['PictureDetails']['PictureURL'])))
+                self.log.error(err_msg, type(item['PictureDetails']['PictureURL']))
 
 
         # ItemSpecifics only exists on GetItem when `IncludeItemSpecifics` is True
         if item.get('ItemSpecifics', False):
-            self.log.debug('Found Specific Details for %d' % (int(item['ItemID'])))
+            self.log.debug('Found Specific Details for %d', item_id)
             if type(item['ItemSpecifics']['NameValueList']) is list:
                 for detail in item['ItemSpecifics']['NameValueList']:
                     if type(detail['Value']) is list:
                         detail['Value'] = ', '.join(detail['Value'])
 
-                    self.__store_key_value(item['ItemID'], detail['Name'], detail['Value'])
+                    metadata.append((detail['Name'], detail['Value']))
 
             # Case for only one ItemSpecifc field
             elif type(item['ItemSpecifics']['NameValueList']) is dict:
                 values = item['ItemSpecifics']['NameValueList']
 
                 if type(values['Value']) is list:
-                    detail['Value'] = ', '.join(detail['Value'])
+                    values['Value'] = ', '.join(values['Value'])
 
-                self.__store_key_value(item['ItemID'], values['Name'], values['Value'])
+                metadata.append((values['Name'], values['Value']))
 
             else:
                 err_msg = 'Unexpected type %s from ItemSpecifics. Expecting either list or str'
-                self.log.error(err_msg % (type(item['ItemSpecifics']['NameValueList'])))
+                self.log.error(err_msg, type(item['ItemSpecifics']['NameValueList']))
+
+        if metadata:
+            self.__store_key_values(item_id, metadata)
 
         return self
 
@@ -433,6 +623,45 @@ class Database:
         """
         return self.__mark_data_as_uploaded('metadata', post_id, item_id)
 
+    def db_image_uploaded(self, item_id, slug, media_id, url):
+        """
+            Remembers that the image with `slug`, which belongs to `item_id`,
+            was uploaded to wordpress as `media_id` and can be found at `url`
+
+            Returns `self`
+        """
+        query = """
+            INSERT OR REPLACE INTO media (
+                slug, item_id, media_id, url
+            ) VALUES (:slug, :item_id, :media_id, :url)
+        """
+        values = {
+            'slug': slug,
+            'item_id': item_id,
+            'media_id': media_id,
+            'url': url,
+        }
+
+        self.__execute(query, values)
+
+        return self
+
+    def db_image_lookup(self, slug):
+        """
+            Searches the database for an image with `slug`
+            that has already been uploaded to wordpress
+
+            Returns a dictionary containing the `media_id` and
+            `url` of the image, or None if it hasn't been uploaded
+        """
+        query = "SELECT media_id, url FROM media WHERE slug = :slug"
+        self.__execute(query, {'slug': slug})
+
+        row = self.__cursor.fetchone()
+        if row is None:
+            return None
+        return dict(row)
+
     def db_ebay_get_request_counter(self):
         """
             Returns an integer that is the total amount of requests today
@@ -535,6 +764,30 @@ class Database:
 
         return self.__fetchone('post_id')
 
+    def db_get_uploaded_item_ids(self):
+        """
+            Searches the local database for all items that
+            have already been uploaded to WooCommerce
+
+            Returns a set containing all the item ids
+        """
+        query = "SELECT item_id FROM items WHERE post_id IS NOT NULL;"
+        self.__execute(query)
+
+        return { row['item_id'] for row in self.__cursor.fetchall() }
+
+    def db_get_item_ids_with_specifics(self):
+        """
+            Searches the local database for all items that already
+            have ItemSpecifics (any metadata that isn't a picture)
+
+            Returns a set containing all the item ids
+        """
+        query = "SELECT DISTINCT item_id FROM item_metadata WHERE key != 'picture_url';"
+        self.__execute(query)
+
+        return { row['item_id'] for row in self.__cursor.fetchall() }
+
     def db_get_inactive_uploaded_item_ids(self):
         query = """
             SELECT item_id FROM items
@@ -7,19 +7,41 @@
 import os
 import sys
 import time
+import random
 import logging
 import datetime
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from requests import exceptions
 
 # Local modules
 from .db import Database
-from .util import LOG_HANDLER
+from .util import LOG_HANDLER, COMMAND_ATTEMPTS, COMMAND_MAX_DELAY, bounded_map
 
 # External modules
 from ebaysdk.trading import Connection as Trading
 from ebaysdk.exception import ConnectionError
 
+# ISO 8601 formats for the date range (required by the API). The range
+# starts at the absolute beginning of the first day, and stops at the
+# absolute end of the last day
+RANGE_START_FORMAT = '%Y-%m-%dT00:00:00.000Z'
+RANGE_STOP_FORMAT = '%Y-%m-%dT23:59:59.999Z'
+
+# The date range filters that GetSellerList accepts. Only one
+# kind (Start, Mod, or End) can be used per request
+DATE_RANGE_FILTERS = (
+    'StartTimeFrom', 'StartTimeTo',
+    'ModTimeFrom', 'ModTimeTo',
+    'EndTimeFrom', 'EndTimeTo',
+)
+
+# How many GetItem requests to have running at the same time
+GET_ITEM_WORKERS = 4
+# How many GetSellerList pages to request at the same time
+SELLER_LIST_WORKERS = 4
+
 class EbayShim(Database):
     """
         Contains various methods for querying the ebay API
@@ -55,30 +77,53 @@ class EbayShim(Database):
         self.pagination_total_items = 0
         self.pagination_total_pages = 0
         self.pagination_received_items = 0
+        # Set once `get_seller_list` has been allowed to run today, so that
+        # a retry carries on from the last page instead of being skipped
+        self.__seller_list_started = False
 
         self.rate_limit = 1000
 
-        # Setup connection to SDK
+        # Setup connection to SDK. The settings are read once, since
+        # every GetItem thread opens a connection of its own as well
+        self.__connection_settings = {
+            'domain': os.environ.get('ebay_domain', False),
+            # 'compatibility': int(os.environ.get('ebay_api_version', 648)),
+            'appid': os.environ.get('ebay_appid', False),
+            'certid': os.environ.get('ebay_certid', False),
+            'devid': os.environ.get('ebay_devid', False),
+            'token': os.environ.get('ebay_token', False),
+        }
         self.ebay = self.__get_api_connection()
+        # Connections for the worker threads (see `__get_connection`)
+        self.__thread_connections = threading.local()
 
     def __get_api_connection(self):
         """
             Creates a new connection to the ebay API (via the SDK)
 
-            All parameters are set via environment variables (see creds.example)
+            All parameters are set via environment variables (see creds.example),
+            which are read into `self.__connection_settings` by `__init__`
         """
-        self.log.info('Opening new API connection to %s' % (os.environ.get('ebay_domain', False)))
+        self.log.info('Opening new API connection to %s', self.__connection_settings['domain'])
         return Trading(
-            domain=os.environ.get('ebay_domain', False),
-            # compatibility=int(os.environ.get('ebay_api_version', 648)),
-            appid=os.environ.get('ebay_appid', False),
-            certid=os.environ.get('ebay_certid', False),
-            devid=os.environ.get('ebay_devid', False),
-            token=os.environ.get('ebay_token', False),
             config_file=None,
-            debug=False
+            debug=False,
+            **self.__connection_settings
         )
 
+    def __get_connection(self):
+        """
+            Returns the connection to the ebay API that belongs to the
+            calling thread, opening one the first time a thread asks
+
+            The SDK connection keeps the last request and response on
+            itself, so worker threads can't share `self.ebay`
+        """
+        connection = getattr(self.__thread_connections, 'ebay', None)
+        if connection is None:
+            connection = self.__thread_connections.ebay = self.__get_api_connection()
+        return connection
+
     def __check_date_type(self, the_date=None):
         """
             Determines if the provided date is either a
@@ -92,13 +137,12 @@ class EbayShim(Database):
             `the_date` is None, today's datetime object
             is returned.
         """
-        if the_date != None:
-            if type(the_date) == type(datetime.datetime.today()):
+        if the_date is not None:
+            if isinstance(the_date, datetime.datetime):
                 self.log.debug('Provided date is a datetime object, passing it through')
                 return the_date
-            elif type(the_date) == type(''):
-                warning = 'Provided date %s is a string, attempting conversion' % (the_date)
-                self.log.warning(warning)
+            elif isinstance(the_date, str):
+                self.log.warning('Provided date %s is a string, attempting conversion', the_date)
                 try:
                     return datetime.datetime.strptime(the_date, '%Y-%m-%d')
                 except ValueError:
@@ -137,20 +181,18 @@ class EbayShim(Database):
         else:
             # If the stop date was not defined, set the range
             # based on `days`, which defaults to the same day
-            self.log.warning('No Stop Date provided, defaulting to Start Date + %d' % (days))
+            self.log.warning('No Stop Date provided, defaulting to Start Date + %d', days)
             stop_date = start_date + datetime.timedelta(days)
 
-        # Convert dates into ISO 8601 (required by the API)
-        # Start date is at the absolute beginning of the day
-        start_date = start_date.strftime('%Y-%m-%dT00:00:00.000Z')
-        # Stop date is at the absolute end of the day
-        stop_date = stop_date.strftime('%Y-%m-%dT23:59:59.999Z')
-
         # If the Stop date is in the past, reverse order
         if stop_date < start_date:
             self.log.info('Stop Date is before Start Date, swapping places')
             stop_date, start_date = start_date, stop_date
 
+        # Convert dates into ISO 8601 (required by the API)
+        start_date = start_date.strftime(RANGE_START_FORMAT)
+        stop_date = stop_date.strftime(RANGE_STOP_FORMAT)
+
         self.date_range = {
             'from': start_date,
             'to': stop_date,
@@ -169,39 +211,31 @@ class EbayShim(Database):
             The filter will then be applied from `self.date_range`
         """
 
-        filters = [
-            'StartTimeFrom', 'StartTimeTo',
-            'ModTimeFrom', 'ModTimeTo',
-            'EndTimeFrom', 'EndTimeTo',
-        ]
-
         # If there is already a date range filter on the seller list an
         # exception will be thrown. We can only search one type at a time
-        for the_filter in filters:
-            try:
-                del self.seller_filter_dict[the_filter]
-                self.log.debug('Filter: %s was already in the seller list, deleted' % (the_filter))
-            except KeyError:
-                continue
+        for the_filter in DATE_RANGE_FILTERS:
+            if self.seller_filter_dict.pop(the_filter, None) is not None:
+                self.log.debug('Filter: %s was already in the seller list, deleted', the_filter)
 
         self.seller_filter_dict[self.date_range['type'] + 'TimeFrom'] = self.date_range['from']
         self.seller_filter_dict[self.date_range['type'] + 'TimeTo'] = self.date_range['to']
 
         return self
 
-    def __update_pagination(self, entries=100):
+    def __update_pagination(self, entries=200):
         """
             Adds the pagination requirements to the seller_list dictionary
             (used in requests such as `GetSellerEvents` and `GetSellerList`)
 
             `entries` is the maximum number of items to return per page.
-            The maximum value allowed by the API is 200, default is 25
+            The maximum value allowed by the API is 200, default is 25.
+            We ask for the maximum, so that as few pages as possible are needed
 
             https://developer.ebay.com/Devzone/XML/docs/Reference/eBay/GetSellerList.html#Request.Pagination.EntriesPerPage
         """
         if entries > 200:
-            self.log.warning('Too many entries requested per page. Maximum is 200 items. Defaulting to 100')
-            entries = 100
+            self.log.warning('Too many entries requested per page. Maximum is 200 items. Defaulting to 200')
+            entries = 200
 
         if not self.seller_filter_dict.get('Pagination', False):
             self.log.info('Pagination value not set in seller_filter, setting defaults')
@@ -214,12 +248,12 @@ class EbayShim(Database):
 
                 pages_left = (self.pagination_total_pages -
                               self.seller_filter_dict['Pagination']['PageNumber'])
-                self.log.info('%d Pages left' % (pages_left))
+                self.log.info('%d Pages left', pages_left)
 
                 if self.pagination_total_items > self.pagination_received_items:
 
                     items_left = self.pagination_total_items - self.pagination_received_items
-                    self.log.info('%d Items left to get' % (items_left))
+                    self.log.info('%d Items left to get', items_left)
 
                     self.seller_filter_dict['Pagination']['PageNumber'] += 1
                 else:
@@ -239,40 +273,69 @@ class EbayShim(Database):
 
             If `self.got_item_ids` does not contain at least one item,
             it will be populated with all items that are marked as active
+
+            Items that already have ItemSpecifics stored are skipped, since
+            every GetItem request counts against the daily rate limit
+
+            Up to `GET_ITEM_WORKERS` items are requested at the same time
         """
 
         if not self.got_item_ids:
             self.got_item_ids = self.db_get_active_item_ids()
 
-        if self.got_item_ids:
-            for item_id in self.got_item_ids:
-                # Remove the current item so that we can store the state
-                self.got_item_ids.remove(item_id)
-
-                if self.db_ebay_get_request_counter() >= self.rate_limit:
-                    self.log.error('Rate limit reached! Storing the remaining ids for next run')
-                    self.db_ebay_store_got_item_ids(self.got_item_ids)
-                    break
+        # Items that we already have the specifics for don't need another request
+        have_specifics = self.db_get_item_ids_with_specifics()
+        self.got_item_ids = [
+            item_id for item_id in self.got_item_ids
+            if int(item_id) not in have_specifics
+        ]
 
-                # Get the item, with specifc details (specs)
-                # Arguments are defined here:
-                # https://developer.ebay.com/Devzone/XML/docs/Reference/eBay/GetItem.html#Request.IncludeItemSpecifics
-                result = self.ebay.execute(
-                    'GetItem',
-                    {
-                        'IncludeItemSpecifics': True,
-                        'ItemID': item_id,
-                    }
-                ).dict()['Item']
+        # Only request as many items as the rate limit has room for
+        allowed = max(0, self.rate_limit - self.db_ebay_get_request_counter())
+        done = 0
 
-                self.db_ebay_increment_request_counter()
-                self.db_store_item_metadata_from_ebay(result)
+        try:
+            with ThreadPoolExecutor(max_workers=GET_ITEM_WORKERS) as pool:
+                results = bounded_map(pool, self.__get_item,
+                                      self.got_item_ids[:allowed], GET_ITEM_WORKERS)
+                # The results come back in order, and are stored from this
+                # thread, since the database connection can't be shared
+                for result in results:
+                    # Commit the counter and all of the item's specifics together
+                    with self.db_transaction():
+                        self.db_ebay_increment_request_counter()
+                        self.db_store_item_metadata_from_ebay(result)
+                    done += 1
+        finally:
+            # Remove the items we got so that we can store the state
+            self.got_item_ids = self.got_item_ids[done:]
 
         if self.got_item_ids:
+            self.log.error('Rate limit reached! Storing the remaining ids for next run')
+            self.db_ebay_store_got_item_ids(self.got_item_ids)
+        else:
             self.db_ebay_store_got_item_ids([])
 
         return self
 
+    def __get_item(self, item_id):
+        """
+            Gets the item with the provided `item_id`, with specific
+            details (specs). Arguments are defined here:
+            https://developer.ebay.com/Devzone/XML/docs/Reference/eBay/GetItem.html#Request.IncludeItemSpecifics
+
+            This runs on the `get_item_metadata` threads
+
+            Returns the Item as a dictionary
+        """
+        return self.__get_connection().execute(
+            'GetItem',
+            {
+                'IncludeItemSpecifics': True,
+                'ItemID': item_id,
+            }
+        ).dict()['Item']
+
     def get_seller_list(self):
         """
             Gets multiple items from the same seller based on the date range
@@ -288,14 +351,59 @@ class EbayShim(Database):
 
         if self.db_ebay_get_request_counter() >= self.rate_limit:
             self.log.error('Rate limit reached! Not getting more items!')
-            # Introduce a fake value to the pagination to
-            # trick `try_command` to break out of the loop
+            # Introduce a fake value to the pagination to trick
+            # anything paging through the results into stopping
             self.pagination_received_items = self.pagination_total_items + 1
             return None
 
         # Run the API request
         result = self.ebay.execute('GetSellerList', self.seller_filter_dict).dict()
 
+        return self.__store_seller_list_page(result)
+
+    def get_remaining_seller_list_pages(self):
+        """
+            Once `get_seller_list` has gotten the first page, and we know
+            how many pages there are, this gets all of the pages after it.
+            Up to `SELLER_LIST_WORKERS` pages are requested at the same time
+
+            Only as many pages as the rate limit has room for are requested
+        """
+        current_page = self.seller_filter_dict['Pagination']['PageNumber']
+        pages = list(range(current_page + 1, self.pagination_total_pages + 1))
+
+        allowed = max(0, self.rate_limit - self.db_ebay_get_request_counter())
+        if len(pages) > allowed:
+            self.log.error('Rate limit reached! Only getting %d of %d pages', allowed, len(pages))
+            pages = pages[:allowed]
+
+        with ThreadPoolExecutor(max_workers=SELLER_LIST_WORKERS) as pool:
+            results = bounded_map(pool, self.__get_seller_list_page, pages, SELLER_LIST_WORKERS)
+            # The pages come back in order, and are stored from this
+            # thread, since the database connection can't be shared
+            for page_number, result in zip(pages, results):
+                self.seller_filter_dict['Pagination']['PageNumber'] = page_number
+                self.__store_seller_list_page(result)
+
+        return self
+
+    def __get_seller_list_page(self, page_number):
+        """
+            Runs GetSellerList for `page_number` with the current filters,
+            on the calling thread's own connection (see `__get_connection`)
+
+            Returns the response as a dictionary
+        """
+        filters = dict(self.seller_filter_dict)
+        filters['Pagination'] = dict(filters['Pagination'], PageNumber=page_number)
+
+        return self.__get_connection().execute('GetSellerList', filters).dict()
+
+    def __store_seller_list_page(self, result):
+        """
+            Stores the items on one page of GetSellerList `result`s,
+            and keeps track of where we are in the pagination
+        """
         # Record that we sent a request to the ebay API
         self.db_ebay_increment_request_counter()
 
@@ -305,40 +413,38 @@ class EbayShim(Database):
         self.pagination_received_items += int(result['ReturnedItemCountActual'])
 
         msg = 'Got %d items out of %d total from the provided date range filter'
-        self.log.info(msg % (self.pagination_received_items, self.pagination_total_items))
+        self.log.info(msg, self.pagination_received_items, self.pagination_total_items)
 
         item_list = result.get('ItemArray', None)
         if item_list is not None:
             items_active, items_inactive = 0, 0
 
             # Ensure that the response is a list containing one or more dictionaries
-            try:
-                for key in item_list['Item']:
-                    _ = key['ItemID']
-            except TypeError:
+            item_list = item_list['Item']
+            if not isinstance(item_list, list):
                 # Only one item was returned
-                item_list = [ item_list['Item'] ]
-            else:
-                item_list = item_list['Item']
+                item_list = [ item_list ]
 
-            for item in item_list:
+            # Commit the whole page at once, rather than every row on its own
+            with self.db_transaction():
                 # Store the items in the database for use in syncing to wordpress
-                self.db_store_item_from_ebay(item)
-
-                if item['SellingStatus']['ListingStatus'] == 'Active':
-                    items_active += 1
-                    # Store the metadata for active items only
-                    self.db_store_item_metadata_from_ebay(item)
-                    # Store active item ids so that we can fetch ItemSpecifics
-                    self.got_item_ids.append(item['ItemID'])
-                else:
-                    items_inactive += 1
-                    self.log.debug(
-                        'Item %s is not active, not getting its metadata' % (item.get('ItemID'))
-                    )
+                self.db_store_items_from_ebay(item_list)
+
+                for item in item_list:
+                    if item['SellingStatus']['ListingStatus'] == 'Active':
+                        items_active += 1
+                        # Store the metadata for active items only
+                        self.db_store_item_metadata_from_ebay(item)
+                        # Store active item ids so that we can fetch ItemSpecifics
+                        self.got_item_ids.append(item['ItemID'])
+                    else:
+                        items_inactive += 1
+                        self.log.debug(
+                            'Item %s is not active, not getting its metadata', item.get('ItemID')
+                        )
 
             msg = '%d Items Active and %d Items inactive'
-            self.log.info(msg % (items_active, items_inactive))
+            self.log.info(msg, items_active, items_inactive)
         else:
             self.log.error('Got no items from the search. Try adjusting the date range')
 
@@ -354,17 +460,21 @@ class EbayShim(Database):
         if self.ebay.response.content and full:
             print("Call Success: %s in length" % (self.ebay.response.content))
 
-        self.log.info("Response Code: %s" % (self.ebay.response_code()))
+        self.log.info("Response Code: %s", self.ebay.response_code())
+
+        # Converting the whole response is expensive, so only do it if it will be logged
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return self
 
         if full:
             self.log.debug(self.ebay.response.content)
             self.log.debug(self.ebay.response.json())
-            self.log.debug("Response Reply: %s" % (self.ebay.response.reply))
+            self.log.debug("Response Reply: %s", self.ebay.response.reply)
         else:
             response = "%s" % (self.ebay.response.dict())
             reply = "%s" % (self.ebay.response.reply)
-            self.log.debug("Response Dictionary: %s..." % (response[:100]))
-            self.log.debug("Response Reply: %s..." % (reply[:100]))
+            self.log.debug("Response Dictionary: %s...", response[:100])
+            self.log.debug("Response Reply: %s...", reply[:100])
 
         return self
 
@@ -376,52 +486,68 @@ class EbayShim(Database):
             and then runs the method specified in the `command` argument in
             a try, except statement
 
-            `command` is a string that is inside `__available_commands`
-        """
-        __available_commands = [
-            'get_seller_list',
-            'get_item_metadata',
-        ]
+            `command` is a string that is a key of `COMMANDS`
 
-        err_msg = "Command %s is unrecognized. Supported commands are: %s" % (
-            command, ', '.join(__available_commands))
+            A command that times out is retried up to `COMMAND_ATTEMPTS` times,
+            waiting exponentially longer between each attempt
+        """
+        function = self.COMMANDS.get(command)
 
-        if command not in __available_commands:
+        if function is None:
+            err_msg = "Command %s is unrecognized. Supported commands are: %s" % (
+                command, ', '.join(self.COMMANDS))
             self.log.error(err_msg)
             raise NameError(err_msg)
 
-        try:
-            if command == 'get_seller_list':
-                if self.db_ebay_got_seller_list_date():
-                    # We need to run this at least once to populate
-                    # `self.pagination_total_items` and `self.pagination_received_items`
-                    self.get_seller_list().__print_response()
+        for attempt in range(COMMAND_ATTEMPTS):
+            try:
+                function(self)
+                return self
 
-                    # If there are still items to get, get them
-                    while self.pagination_received_items < self.pagination_total_items:
-                        self.get_seller_list().__print_response()
+            except ConnectionError as e:
+                self.log.exception(e)
+                self.log.exception(e.response.dict())
+                return self
 
-                    return self
-                else:
-                    self.log.warning("Get Seller List already ran today. Skipping")
+            except exceptions.ReadTimeout:
+                # Don't wait if there isn't another attempt left
+                if attempt == COMMAND_ATTEMPTS - 1:
+                    break
 
-            elif command == 'get_item_metadata':
-                self.get_item_metadata()
+                # Back off exponentially (5s, 10s, 20s...), with some jitter
+                delay = min(COMMAND_MAX_DELAY, 5 * 2 ** attempt) + random.uniform(0, 1)
+                self.log.warning('The Previous request Timed Out. Waiting %ds before retrying', delay)
+                time.sleep(delay)
 
-            else:
-                self.log.error(err_msg)
-                raise NameError(err_msg)
+        self.log.error('%s timed out %d times, giving up', command, COMMAND_ATTEMPTS)
+        return self
 
-        except ConnectionError as e:
-            self.log.exception(e)
-            self.log.exception(e.response.dict())
+    def __run_seller_list(self):
+        """
+            Gets every page of GetSellerList, unless it already ran today
 
-        except exceptions.ReadTimeout:
-            self.log.warning('The Previous request Timed Out. Waiting 5s before retrying')
-            time.sleep(5)
-            self.try_command(command)
+            When `try_command` retries this after a timeout, it carries on
+            from the last page that was stored, rather than checking the date
+            again (which this run has already set to today)
+        """
+        if not self.__seller_list_started:
+            if not self.db_ebay_got_seller_list_date():
+                self.log.warning("Get Seller List already ran today. Skipping")
+                return self
+            self.__seller_list_started = True
+
+        if not self.pagination_total_pages:
+            # We need to run this at least once to populate
+            # `self.pagination_total_items` and `self.pagination_total_pages`
+            self.get_seller_list().__print_response()
 
-        except NameError:
-            pass
+        # If there are still pages to get, get them
+        self.get_remaining_seller_list_pages()
 
         return self
+
+    # The methods that `try_command` can run, looked up by the command name
+    COMMANDS = {
+        'get_seller_list': __run_seller_list,
+        'get_item_metadata': get_item_metadata,
+    }
@@ -6,14 +6,39 @@
 """
     This file contains constants and utility methods
     that are used all over the place
-
-    For now, the only constant we need is LOG_HANDLER
 """
 
 import sys
 import logging
+import collections
 
 # Log to console
 LOG_HANDLER = logging.StreamHandler(sys.stdout)
 LOG_FORMAT = logging.Formatter('%(asctime)s - %(name)s.%(funcName)s - %(levelname)s - %(message)s')
 LOG_HANDLER.setFormatter(LOG_FORMAT)
+
+# How many times `try_command` runs a command that keeps timing out,
+# and the most seconds it will wait between attempts
+COMMAND_ATTEMPTS = 6
+COMMAND_MAX_DELAY = 60
+
+def bounded_map(pool, function, iterable, window):
+    """
+        Lazy version of `Executor.map` that only keeps `window` calls to
+        `function` in flight on the `pool` at once
+
+        `Executor.map` submits everything up front, which means every result
+        (such as a downloaded image) could be held in memory at the same time.
+        This only submits the next item once a result has been taken
+
+        Yields the results in the same order as `iterable`
+    """
+    pending = collections.deque()
+
+    for item in iterable:
+        pending.append(pool.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
@@ -7,14 +7,20 @@ import os
 import sys
 import json
 import time
+import random
 import logging
+import functools
+import itertools
 import requests
 
 from socket import timeout
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
 
 from .db import Database
-from .util import LOG_HANDLER
+from .util import LOG_HANDLER, COMMAND_ATTEMPTS, COMMAND_MAX_DELAY, bounded_map
 from .image import Image
 
 from woocommerce import API as WCAPI
@@ -25,6 +31,67 @@ DEFAULT_DESCRIPTION = """
 [wpforms id="5280"]
 """
 
+# (connect, read) timeouts in seconds for downloading images from ebay
+IMAGE_DOWNLOAD_TIMEOUT = (5, 30)
+# Headers sent with every image upload to wordpress
+MEDIA_UPLOAD_HEADERS = {
+    'cache-control': 'no-cache',
+}
+# How many images to download from ebay at the same time
+IMAGE_DOWNLOAD_WORKERS = 4
+# How many products to create or update per `products/batch` request
+PRODUCT_BATCH_SIZE = 25
+# How many images to upload to wordpress at the same time
+IMAGE_UPLOAD_WORKERS = 4
+# How many `products/batch` delete requests to have running at the same time,
+# unless overridden by the `woo_parallelism` environment variable
+DELETE_WORKERS = 4
+
+@functools.lru_cache(maxsize=None)
+def load_category_mapping(mapping_path):
+    """
+        Reads and parses the category mapping JSON file at `mapping_path`
+
+        The result is cached for the life of the process, so every shim
+        instance shares one parsed copy instead of re-reading the file
+
+        Returns the parsed mapping, or None if the file can't be read
+    """
+    try:
+        with open(mapping_path, 'r') as mapping_file:
+            return json.load(mapping_file)
+    except IOError:
+        return None
+
+@functools.lru_cache(maxsize=None)
+def index_category_mapping(mapping_path):
+    """
+        Builds a dictionary out of the category mapping at `mapping_path`
+        that maps each ebay category id to the first Woo Commerce ID it is
+        listed under (in the case that one ebay category is mapped to multiple
+        woo commerce categories), so that looking up a category doesn't have
+        to scan the whole mapping for every product
+
+        Also finds the id of the "Uncategorized" category, which is used
+        when an ebay category isn't in the mapping
+
+        Like the mapping itself, this is only built once per process and
+        is shared between shim instances, so it must not be modified
+
+        Returns a tuple of the dictionary and the uncategorized id (or None)
+    """
+    category_ids = dict()
+    uncategorized_id = None
+
+    for category in load_category_mapping(mapping_path) or []:
+        for ebay_id in category.get('ebay_ids', []):
+            category_ids.setdefault(ebay_id, int(category['wc-id']))
+
+        if uncategorized_id is None and category.get('wc-name') == 'Uncategorized':
+            uncategorized_id = int(category['wc-id'])
+
+    return category_ids, uncategorized_id
+
 class WooCommerceShim(Database):
     """
         Contains various methods for interacting with
@@ -44,7 +111,9 @@ class WooCommerceShim(Database):
         self.api = WCAPI(
             url=os.environ.get('woo_url', False),
             consumer_key=os.environ.get('woo_key', False),
-            consumer_secret=os.environ.get('woo_secret', False)
+            consumer_secret=os.environ.get('woo_secret', False),
+            # Batch requests take much longer than the default 5 seconds
+            timeout=int(os.environ.get('woo_timeout', 60))
         )
 
         self.wp_api = WPAPI(
@@ -59,13 +128,73 @@ class WooCommerceShim(Database):
             consumer_secret=False
         )
 
+        # The wordpress client already keeps its connections alive in a
+        # session. Let it back off and retry its media searches when the
+        # server is overloaded (uploads are POSTs, which are never retried).
+        # Read timeouts are left to `try_command`, and the last response is
+        # returned rather than raising once the retries are used up
+        self.wp_api.requester.session.mount('https://', HTTPAdapter(
+            max_retries=Retry(total=3, read=False, backoff_factor=0.5,
+                              status_forcelist=[429, 502, 503, 504],
+                              respect_retry_after_header=True,
+                              raise_on_status=False)
+        ))
+
+        # Ebay serves every image from the same few hosts, so keep the
+        # connections alive between downloads instead of re-handshaking.
+        # Rather than pausing between every download, only back off when
+        # the server asks us to (429/503 honour its Retry-After header).
+        # Once the retries run out, the last response is returned so that
+        # it is skipped by the content type check, and read timeouts are
+        # raised as they are, rather than wrapped in a ConnectionError
+        self.http = requests.Session()
+        self.http.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, read=False, backoff_factor=0.5,
+                              status_forcelist=[429, 502, 503, 504],
+                              respect_retry_after_header=True,
+                              raise_on_status=False)
+        ))
+
+        # Whether a media slug exists on wordpress, filled in as we find out
+        self.media_slugs = dict()
+        # Item ids that are already on WooCommerce (loaded by `does_product_exist`)
+        self.uploaded_item_ids = None
+        # Image galleries waiting to be set (sent by `flush_gallery_updates`)
+        self.pending_gallery_updates = list()
+        # How many bulk requests the store can handle at the same time
+        self.parallelism = self.__get_parallelism()
+
         mapping_path = os.environ.get('category_mapping',
                                       'database/ebay-to-woo-commerce-category-map.json')
+        self.category_mapping = load_category_mapping(mapping_path)
+        if self.category_mapping is not None:
+            self.__category_ids, self.__uncategorized_id = index_category_mapping(mapping_path)
+
+    def __get_parallelism(self):
+        """
+            Reads `woo_parallelism` from the environment, defaulting
+            to `DELETE_WORKERS`
+
+            Raises a ValueError if it isn't a whole number. Anything
+            below 1 is treated as 1, since a thread pool needs at
+            least one worker
+
+            Returns an integer
+        """
+        value = os.environ.get('woo_parallelism', DELETE_WORKERS)
+
         try:
-            with open(mapping_path, 'r') as mapping_file:
-                self.category_mapping = json.load(mapping_file)
-        except IOError:
-            self.category_mapping = None
+            parallelism = int(value)
+        except ValueError:
+            raise ValueError(
+                'woo_parallelism must be a whole number, got %r' % (value)) from None
+
+        if parallelism < 1:
+            self.log.warning('woo_parallelism is %d, using 1 instead', parallelism)
+
+        return max(1, parallelism)
 
     def __does_image_exist_on_woocommerce(self, slug):
         """
@@ -75,64 +204,89 @@ class WooCommerceShim(Database):
 
             Returns True if the file exists, and False otherwise
 
+            Answers are remembered in `self.media_slugs` for the rest of the
+            run (and uploads add to it), so each slug is only asked about once
+
             This method is unreliable! Duplicates are basically guarenteed to happen...
         """
 
-        self.log.info('Checking if a file has a slug matching: %s' % (slug))
-        result = self.wp_api.get('/media?slug=%s' % (slug)).json()
+        if slug not in self.media_slugs:
+            self.log.info('Checking if a file has a slug matching: %s', slug)
+            result = self.wp_api.get('/media?slug=%s&per_page=1&_fields=id' % (slug)).json()
+            self.media_slugs[slug] = len(result) > 0
+
+        return self.media_slugs[slug]
+
+    def __prefetch_media_slugs(self, slugs):
+        """
+            Asks the Wordpress media library about all of the `slugs` at
+            once (up to 100 per request, the most the API will return per
+            page) instead of one request per slug, and remembers the answers
+            in `self.media_slugs`
+
+            Slugs that have already been looked up are not asked about again
+
+            Only the slugs of the matches are requested, which saves
+            wordpress from building (and us from parsing) the full records
+
+            Returns None
+        """
+        unknown_slugs = [slug for slug in slugs if slug not in self.media_slugs]
+
+        for chunk in self.__divide_into_chunks(unknown_slugs, 100):
+            self.log.info('Checking if files have slugs matching: %s', ', '.join(chunk))
+            result = self.wp_api.get(
+                '/media?slug=%s&per_page=%d&_fields=slug' % (','.join(chunk), len(chunk))).json()
 
-        if len(result) == 0:
-            return False
-        return True
+            for slug in chunk:
+                self.media_slugs[slug] = False
+            for media in result:
+                self.media_slugs[media.get('slug')] = True
 
     def __divide_into_chunks(self, iterable, chunk_size=100):
         """
             Used to make bulk requests via the API, which limits
             the amount of products to change at once to 100
 
-            `iterable` is something that can be iterated over, be
-            it a list or a range. When a range, you must wrap the
-            output of this method in `list()`
+            `iterable` is anything that can be iterated over, be
+            it a list, a range, or a generator. It is consumed
+            lazily, so it never has to be held in memory all at once
 
             `chunk_size` is optional, and defines how many products
             to change per request. The default of 100 is the maximum
             that the API will allow
 
-            Returns the `iterable` containing as many items as are
-            in the `chunk_size`
+            Yields lists containing up to `chunk_size` items
         """
-        for i in range(0, len(iterable), chunk_size):
-            yield iterable[i:i + chunk_size]
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk
 
-    def __search_map(self, value, field):
+    def does_product_exist(self, item_id):
         """
-            Uses List Comprehension to search for the `value` in the `field`.
-
-            Normal usage would be similar to `self.__search_map(ebay_category_id, 'ebay_ids')`
-
-            Returns an integer, which is the first matching Woo Commerce ID for
-            the selected `value` (in the case that one ebay category is mapped to
-            multiple woo commerce categories)
+            Determines if the product with the `item_id` has
+            already been uploaded to WooCommerce, by checking
+            if it has a `post_id`
 
-            When a matching category can't be found, this method will call itself
-            to search for the "Uncategorized" `value` on the "wc-name" `field`
+            All of the uploaded item ids are read from the database
+            the first time this is called, and kept up to date as
+            products are created, so that each check is a set lookup
         """
-        try:
-            mapped = [key for key in self.category_mapping if value in key[field]]
-            return int(mapped[0]['wc-id'])
-        except IndexError: # Couldn't find it, return the uncategorized id
-            return self.__search_map('Uncategorized', 'wc-name')
+        if self.uploaded_item_ids is None:
+            self.uploaded_item_ids = self.db_get_uploaded_item_ids()
+        return item_id in self.uploaded_item_ids
 
-    def does_product_exist(self, item_id):
+    def __product_uploaded(self, post_id, item_id):
         """
-            Determines if the product with the `item_id` has
-            already been uploaded to WooCommerce, by checking
-            for the truthyness of `post_id`
+            Records that the product for `item_id` is on WooCommerce
+            as `post_id`, both in the database and `self.uploaded_item_ids`
         """
-        data = self.db_get_product_data(item_id)
-        if data.get('post_id') is not None:
-            return True
-        return False
+        self.db_product_uploaded(post_id, item_id)
+        if self.uploaded_item_ids is not None:
+            self.uploaded_item_ids.add(item_id)
 
     def get_mapped_category_id(self, ebay_category_id):
         """
@@ -145,72 +299,98 @@ class WooCommerceShim(Database):
             this method returns None
         """
         if self.category_mapping is not None:
-            return self.__search_map(ebay_category_id, 'ebay_ids')
+            return self.__category_ids.get(ebay_category_id, self.__uncategorized_id)
         return None
 
+    def __download_image(self, item_id, count, url):
+        """
+            Downloads a single image from `url` for the provided `item_id`.
+            `count` is the position of the image in the listing, and is
+            used to build the slug and file name
+
+            Returns an `Image`, or None if the download didn't give us an image
+        """
+        self.log.info("Downloading %s", url)
+        # Only the headers are read here, so that error pages can be
+        # thrown away without downloading them
+        req = self.http.get(url, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+
+        # Drop parameters such as `; charset=utf-8`
+        mime_type = req.headers.get('Content-Type', '').split(';')[0].strip()
+        if not mime_type.startswith('image/'):
+            req.close()
+            msg = "%d didn't get an image somehow. Content type was: %s"
+            self.log.error(msg, item_id, mime_type)
+            return None
+
+        if not req.content:
+            self.log.error("No content returned. Is %s reachable in a browser?", url)
+            return None
+
+        slug = '%s-%d' % (item_id, count)
+        extension = mime_type.split('/')[1]
+
+        return Image(
+            slug = slug,
+            ebay_url = url,
+            name = '%s.%s' % (slug, extension),
+            mime_type = mime_type,
+            data = req.content
+        )
+
     def download_product_images_from_ebay(self, item_id):
         """
             Downloads all of the images for a provided `item_id` and
-            returns a dictionary containing the image name, mime type, and
-            bytes-like object for the raw images
+            yields `Image` objects containing the image name, mime type,
+            and bytes-like object for the raw images
+
+            The images are downloaded concurrently (`IMAGE_DOWNLOAD_WORKERS`
+            at a time) over the pooled `self.http` session, and are yielded
+            in the same order as their URLs. Only `IMAGE_DOWNLOAD_WORKERS`
+            images are downloaded ahead of the caller, so uploading one image
+            overlaps with downloading the next ones without ever holding the
+            whole gallery in memory
 
             The image URLs come from the database table `item_metadata`,
             which is populated when `self.__get_item_metadata()` runs
         """
 
-        count = 0
-        return_images = list()
-
         image_urls = self.db_get_product_image_urls(item_id)
-        image_urls_count = len(image_urls)
 
-        if image_urls_count > 0:
-            self.log.info("Found %d image URLs for: %s" % (image_urls_count, item_id))
+        if not image_urls:
+            self.log.warning("No Image URLs found for item: %s", item_id)
+            return
 
-            for image in image_urls:
-                url = image.get('value', '')
+        self.log.info("Found %d image URLs for: %s", len(image_urls), item_id)
 
-                if image.get('post_id') is not None:
-                    self.log.warning("We've already uploaded %s, skipping download" % (url))
-                    continue
+        slugs = [ '%s-%d' % (item_id, count) for count in range(len(image_urls)) ]
 
-                self.log.info("Downloading %s" % (url))
-                req = requests.get(url)
+        # Images that a previous run uploaded don't need to be looked for again
+        uploaded = { slug for slug in slugs if self.db_image_lookup(slug) is not None }
 
-                if req.content:
-                    mime_type = req.headers.get('Content-Type', '')
-                    slug = '%s-%d' % (item_id, count)
-                    extension = mime_type.split('/')[1]
-                    filename = '%s.%s' % (slug, extension)
+        # Find out which of the other images are already on wordpress in one request
+        self.__prefetch_media_slugs([ slug for slug in slugs if slug not in uploaded ])
 
-                    if 'image' not in mime_type:
-                        msg = "%d didn't get an image somehow. Content type was: %s"
-                        self.log.error(msg % (item_id, mime_type))
-                        continue
+        to_download = list()
+        for count, image in enumerate(image_urls):
+            url = image.get('value', '')
 
-                    return_images.append(Image(
-                        slug = slug,
-                        ebay_url = url,
-                        name = filename,
-                        mime_type = mime_type,
-                        data = req.content
-                    ))
+            if image.get('post_id') is not None or slugs[count] in uploaded:
+                self.log.warning("We've already uploaded %s, skipping download", url)
+                continue
 
-                    # self.log.info("Image %s downloaded" % (filename))
+            if self.__does_image_exist_on_woocommerce(slugs[count]):
+                self.log.warning("%s is already on wordpress, skipping download", url)
+                continue
 
-                    if count < image_urls_count:
-                        self.log.debug("Waiting a quarter second until next download")
-                        time.sleep(0.25)
-                else:
-                    self.log.error(
-                        "No content returned. Is %s reachable in a browser?" % (url)
-                    )
+            to_download.append((item_id, count, url))
 
-                count += 1
-        else:
-            self.log.warning("No Image URLs found for item: %s" % (item_id))
-
-        return return_images
+        with ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as pool:
+            downloads = bounded_map(pool, lambda args: self.__download_image(*args),
+                                    to_download, IMAGE_DOWNLOAD_WORKERS)
+            for image in downloads:
+                if image is not None:
+                    yield image
 
     def upload_image_to_woocommerce(self, image, post_id):
         """
@@ -233,33 +413,34 @@ class WooCommerceShim(Database):
             if the image fails to be uploaded
         """
 
-        self.log.info("Uploading %s to wordpress" % (image.name))
+        self.log.info("Uploading %s to wordpress", image.name)
+
+        # Don't upload a duplicate image if it was uploaded in the past
+        if self.__does_image_exist_on_woocommerce(image.slug):
+            self.log.warning(
+                "Image %s already exists on wordpress. Not uploading again", image.name)
+            return None, None
 
         endpoint = '/media?post=%d' % (post_id)
 
         headers = {
-            'cache-control': 'no-cache',
+            **MEDIA_UPLOAD_HEADERS,
             'content-disposition': 'attachment; filename=%s' % (image.name),
-            'content-type': '%s' % (image.mime_type)
+            'content-type': image.mime_type,
         }
 
-        # Don't upload a duplicate image if it was uploaded in the past
-        if self.__does_image_exist_on_woocommerce(image.slug):
-            self.log.warning(
-                "Image %s already exists on wordpress. Not uploading again" % (image.name)
-            )
-            return None, None
-
         # Upload the image
         response = self.wp_api.post(endpoint, image.data, headers=headers)
 
         try:
-            image_id = response.json().get('id')
-            url = response.json().get('guid', dict).get('raw')
-            self.log.debug("Uploaded %s to %s" % (image.name, url))
+            body = response.json()
+            image_id = body.get('id')
+            url = body.get('guid', {}).get('raw')
+            self.log.debug("Uploaded %s to %s", image.name, url)
+            self.media_slugs[image.slug] = True
             return image_id, url
         except AttributeError:
-            self.log.error('Could not upload %s' % image.name)
+            self.log.error('Could not upload %s', image.name)
             return None, None
 
     def upload_product_images(self, item_id):
@@ -271,38 +452,105 @@ class WooCommerceShim(Database):
             When the post_id is found, it will be used
             to download the images for that product
             from ebay, and then upload the images
+
+            Up to `IMAGE_UPLOAD_WORKERS` images are uploaded at the same
+            time. The results are handled here, in the order of the images,
+            so that the database is only used from this thread
+
+            The images are only recorded as uploaded once the gallery has
+            been set by `flush_gallery_updates`
         """
         post_id = self.db_woo_get_post_id(item_id)
-        gallery = []
+        uploaded = []
 
         if post_id is not None:
-            for image in self.download_product_images_from_ebay(item_id):
-                image_id, url = self.upload_image_to_woocommerce(image, post_id)
-                if image_id and url:
-                    self.db_metadata_uploaded(image_id, item_id)
-                    gallery.append({'id': image_id})
-
-            # Add the images to the gallery
-            self.api.put('products/%d' % (post_id), {'images': gallery}).json()
+            with ThreadPoolExecutor(max_workers=IMAGE_UPLOAD_WORKERS) as pool:
+                uploads = bounded_map(pool,
+                                      lambda image: (image.slug, self.upload_image_to_woocommerce(image, post_id)),
+                                      self.download_product_images_from_ebay(item_id),
+                                      IMAGE_UPLOAD_WORKERS)
+                for slug, (image_id, url) in uploads:
+                    if image_id and url:
+                        uploaded.append((slug, image_id, url))
+
+            # Add the images to the gallery. This is sent along with other
+            # products' galleries by `flush_gallery_updates`
+            if uploaded:
+                self.pending_gallery_updates.append({
+                    'item_id': item_id,
+                    'post_id': post_id,
+                    'images': uploaded,
+                })
+                if len(self.pending_gallery_updates) >= PRODUCT_BATCH_SIZE:
+                    self.flush_gallery_updates()
         else:
-            self.log.warning('The product %d has not yet been uploaded' % (item_id))
+            self.log.warning('The product %d has not yet been uploaded', item_id)
 
         return self
 
-    def create_product(self, item_id):
+    def flush_gallery_updates(self):
         """
-            Pulls the product related to the `item_id`
-            out of the database and uploads it to WooCommerce
+            Sets the image galleries that `upload_product_images` has queued
+            up, using the `products/batch` endpoint to update many products
+            per request instead of one request per product
+
+            This has to be called once all of the images have been uploaded,
+            otherwise the last few galleries will never be set
 
-            Returns the result as JSON
+            The images in each batch are recorded as uploaded once that batch
+            has been sent, and only then removed from the queue, so that
+            `try_command` sends whatever is left if a batch times out.
+            Products that WooCommerce couldn't update are logged instead,
+            and their images are not recorded
+
+            Returns `self`
+        """
+        while self.pending_gallery_updates:
+            chunk = self.pending_gallery_updates[:PRODUCT_BATCH_SIZE]
+
+            galleries = [
+                {
+                    'id': update['post_id'],
+                    'images': [ {'id': image_id} for _, image_id, _ in update['images'] ],
+                }
+                for update in chunk
+            ]
+
+            self.log.info('Setting the image galleries for %d products', len(chunk))
+            res = self.api.post('products/batch', {'update': galleries}).json()
+
+            updated = res.get('update')
+            if updated is None:
+                self.log.error('Unable to set the image galleries for %d products', len(chunk))
+                self.log.debug(res)
+                updated = list()
+
+            # The API responds with the products in the order they were sent
+            with self.db_transaction():
+                for update, product_res in zip(chunk, updated):
+                    if product_res.get('error'):
+                        self.log.error('Unable to set the image gallery for %s', update['item_id'])
+                        self.log.debug(product_res)
+                        continue
+
+                    for slug, image_id, url in update['images']:
+                        self.db_image_uploaded(update['item_id'], slug, image_id, url)
+                        self.db_metadata_uploaded(image_id, update['item_id'])
+
+            del self.pending_gallery_updates[:len(chunk)]
+
+        return self
+
+    def __build_product_data(self, item_id):
+        """
+            Pulls the product related to the `item_id` out of the
+            database and formats it the way WooCommerce expects
+            a new product to look
+
+            Returns a dictionary that can be sent to the products API
         """
         attributes = list()
         attributes_to_upload = list()
-        self.log.info('Creating a WooCommerce product from ebay id: %s' % (item_id))
-
-        if self.does_product_exist(item_id):
-            self.log.warning('Product with item id %d already exists, skipping' % (item_id))
-            return self
 
         product = self.db_get_product_data(item_id)
         attributes = self.db_get_all_product_metadata(item_id)
@@ -339,27 +587,126 @@ class WooCommerceShim(Database):
         if category_id is not None:
             upload_data['categories'] = [{ 'id': category_id }]
 
-        res = self.api.post('products', upload_data).json()
+        return upload_data
+
+    def __record_created_product(self, item_id, res, upload_data):
+        """
+            Stores the post id that WooCommerce gave the product created
+            from `item_id`. `res` is the part of the API response for that
+            product, and `upload_data` is what we sent for it
 
+            Returns None
+        """
         self.log.debug(res)
 
         if res.get('id', False):
-            self.db_product_uploaded(res['id'], item_id)
+            self.__product_uploaded(res['id'], item_id)
+            return
+
+        # Batch responses nest the error, single responses don't
+        error = res.get('error', res)
+
+        # Invalid or duplicate sku
+        if error.get('code') == 'product_invalid_sku':
+            if error.get('data') and error['data'].get('resource_id'):
+                new_post_id = error['data']['resource_id']
+                self.log.warning(
+                    'The SKU for %s already exists for %s. Updating.', new_post_id, item_id)
+                self.__product_uploaded(new_post_id, item_id)
         else:
-            # Invalid or duplicate sku
-            if res.get('code') == 'product_invalid_sku':
-                if res.get('data') and res['data'].get('resource_id'):
-                    new_post_id = res['data']['resource_id']
-                    self.log.warning(
-                        'The SKU for %s already exists for %s. Updating.' % (new_post_id, item_id))
-                    self.db_product_uploaded(new_post_id, item_id)
-            else:
-                self.log.error('Unable to retrive product_id')
+            self.log.error('Unable to retrive product_id')
+            self.log.debug(res)
+            self.log.debug(upload_data)
+
+    def __get_existing_products_by_sku(self, skus):
+        """
+            Searches WooCommerce for any products that have one of the `skus`,
+            using a single request for up to 100 skus
+
+            Returns a dictionary of the sku to the post id for each product found
+        """
+        # Let requests encode the skus, which can contain characters such as & or #
+        result = self.api.get('products', params={
+            'sku': ','.join(skus),
+            'per_page': len(skus),
+            '_fields': 'id,sku',
+        }).json()
+
+        if not isinstance(result, list):
+            self.log.error('Unable to search for existing SKUs')
+            self.log.debug(result)
+            return {}
+
+        return { product['sku']: product['id'] for product in result if product.get('sku') }
+
+    def create_products(self, item_ids, chunk_size=PRODUCT_BATCH_SIZE):
+        """
+            Pulls the products related to the `item_ids`
+            out of the database and uploads them to WooCommerce
+
+            Products are created with the `products/batch` endpoint,
+            `chunk_size` at a time, rather than one request per product.
+            The API limits a batch to 100 products, but large batches
+            take long enough to create that the request times out
+
+            Returns `self`
+        """
+        to_create = list()
+
+        for item_id in item_ids:
+            self.log.info('Creating a WooCommerce product from ebay id: %s', item_id)
+
+            if self.does_product_exist(item_id):
+                self.log.warning('Product with item id %d already exists, skipping', item_id)
+                continue
+
+            to_create.append((item_id, self.__build_product_data(item_id)))
+
+        for chunk in self.__divide_into_chunks(to_create, chunk_size):
+            # Products that are already on WooCommerce (such as after the local
+            # database was reset) only need their post id recorded
+            existing = self.__get_existing_products_by_sku(
+                [ upload_data['sku'] for _, upload_data in chunk ])
+
+            new_products = list()
+            for item_id, upload_data in chunk:
+                if upload_data['sku'] in existing:
+                    self.log.warning('The SKU for %s already exists for %s. Updating.',
+                                     existing[upload_data['sku']], item_id)
+                    self.__product_uploaded(existing[upload_data['sku']], item_id)
+                else:
+                    new_products.append((item_id, upload_data))
+
+            if not new_products:
+                continue
+            chunk = new_products
+
+            data = {
+                'create': [ upload_data for _, upload_data in chunk ]
+            }
+            res = self.api.post('products/batch', data).json()
+
+            created = res.get('create')
+            if created is None:
+                self.log.error('Unable to create a batch of %d products', len(chunk))
                 self.log.debug(res)
-                self.log.debug(upload_data)
+                continue
+
+            # The API responds with the products in the order they were sent
+            for (item_id, upload_data), product_res in zip(chunk, created):
+                self.__record_created_product(item_id, product_res, upload_data)
 
         return self
 
+    def create_product(self, item_id):
+        """
+            Pulls the product related to the `item_id`
+            out of the database and uploads it to WooCommerce
+
+            Returns `self`
+        """
+        return self.create_products([item_id])
+
     def delete_product_images(self, item_id):
         """
             With the provided `item_id`, an API request will
@@ -389,15 +736,16 @@ class WooCommerceShim(Database):
         """
         post_id = self.db_woo_get_post_id(item_id)
         if post_id is not None:
-            self.log.info('Deleting %d from WooCommerce' % (item_id))
+            self.log.info('Deleting %d from WooCommerce', item_id)
             try:
                 response = self.api.delete('products/%d' % (post_id), params={'force': True}).json()
             except TypeError:
-                self.log.error("Got unexpected response type: %s" % (str(response)))
+                self.log.error("Got unexpected response type deleting %d", item_id)
                 return None
 
             self.delete_product_images(post_id)
-            status_code = response.get('data', dict).get('staus', 500)
+            # Errors carry their status in `data`, the deleted product does not
+            status_code = response.get('data', {}).get('status', 200)
 
             if status_code == 404:
                 self.log.warning("Product was already deleted")
@@ -423,21 +771,34 @@ class WooCommerceShim(Database):
 
             Returns None
         """
-        self.log.info('Deleting products from %d to %d' % (id_range[0], id_range[-1]))
+        self.log.info('Deleting products from %d to %d', id_range[0], id_range[-1])
 
         # The API says that it supports chunks up to 100 items, but in testing
         # it would always time out, even if it successfully deleted the items
         # with any chunk size greater than or equal to 50
-        for chunk in self.__divide_into_chunks(id_range, chunk_size):
-            post_ids = list(chunk)
-            data = {
-                'delete': post_ids
-            }
-            self.api.post('products/batch', data)
-            self.log.info('Deleted ids %s' % (post_ids))
+        with ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            futures = [
+                pool.submit(self.__delete_chunk, post_ids)
+                for post_ids in self.__divide_into_chunks(id_range, chunk_size)
+            ]
+
+            for future in as_completed(futures):
+                for post_id in future.result():
+                    self.delete_product_images(post_id)
+
+    def __delete_chunk(self, post_ids):
+        """
+            Force deletes all of the `post_ids` with one bulk request
 
-            for post_id in post_ids:
-                self.delete_product_images(post_id)
+            Returns the `post_ids` that were deleted
+        """
+        data = {
+            'delete': post_ids
+        }
+        self.api.post('products/batch', data)
+        self.log.info('Deleted ids %s', post_ids)
+
+        return post_ids
 
     def try_command(self, command, data):
         """
@@ -447,47 +808,54 @@ class WooCommerceShim(Database):
             and then runs the method specified in the `command` argument in
             a try, except statement
 
-            `command` is a string that is inside `__available_commands`
+            `command` is a string that is a key of `COMMANDS`
+
+            A command that times out is retried up to `COMMAND_ATTEMPTS` times,
+            waiting exponentially longer between each attempt
 
             `data` is dependent on the type of command that is being ran.
             In most instances, it is an integer containing the ebay ItemID.
 
+            With the `create_products` command, it is a list of ebay ItemIDs.
+
+            With the `flush_gallery_updates` command, it is ignored.
+
             With the `delete_all_products` command, it is either a range or
             a list containing the post ids for existing products
         """
-        __available_commands = [
-            'create_product',
-            'delete_product',
-            'upload_images',
-            'delete_all_products',
-        ]
-
-        err_msg = "Command %s is unrecognized. Supported commands are: %s" % (
-            command, ', '.join(__available_commands))
+        function = self.COMMANDS.get(command)
 
-        if command not in __available_commands:
+        if function is None:
+            err_msg = "Command %s is unrecognized. Supported commands are: %s" % (
+                command, ', '.join(self.COMMANDS))
             self.log.exception(err_msg)
             raise NameError(err_msg)
 
-        try:
-            if command == 'create_product':
-                return self.create_product(data)
+        for attempt in range(COMMAND_ATTEMPTS):
+            try:
+                return function(self, data)
 
-            elif command == 'delete_product':
-                return self.delete_product(data)
+            # The several kinds of timeout exceptions that are normally returned by the API
+            except (timeout, ReadTimeoutError, requests.exceptions.ConnectTimeout, requests.exceptions.ReadTimeout):
+                # Don't wait if there isn't another attempt left
+                if attempt == COMMAND_ATTEMPTS - 1:
+                    break
 
-            elif command == 'upload_images':
-                return self.upload_product_images(data)
+                # Back off exponentially (5s, 10s, 20s...), with some jitter
+                delay = min(COMMAND_MAX_DELAY, 5 * 2 ** attempt) + random.uniform(0, 1)
+                self.log.warning('The Previous request Timed Out. Waiting %ds before retrying', delay)
+                time.sleep(delay)
 
-            elif command == 'delete_all_products':
-                return self.delete_all_products_in_range(data)
+        # Name what was abandoned, so that it can be ran again by hand
+        self.log.error('%s timed out %d times, giving up on %s', command, COMMAND_ATTEMPTS, data)
+        return None
 
-            else:
-                self.log.exception(err_msg)
-                raise NameError(err_msg)
-
-        # The several kinds of timeout exceptions that are normally returned by the API
-        except (timeout, ReadTimeoutError, requests.exceptions.ConnectTimeout, requests.exceptions.ReadTimeout):
-            self.log.warning('The Previous request Timed Out. Waiting 5s before retrying')
-            time.sleep(5)
-            self.try_command(command, data)
+    # The methods that `try_command` can run, looked up by the command name
+    COMMANDS = {
+        'create_product': create_product,
+        'create_products': create_products,
+        'delete_product': delete_product,
+        'upload_images': upload_product_images,
+        'flush_gallery_updates': lambda self, data: self.flush_gallery_updates(),
+        'delete_all_products': delete_all_products_in_range,
+    }